@@ -3,11 +3,56 @@ Generates vehicle sales reports based on Sqlite database.
 """
 import os
 import sqlite3
+import numba
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv
 import logging
-import datetime as dt
 from typing import Optional, List
 
+
+@numba.njit(cache=True)
+def _next_vehicle_kernel(customer_ids, dates_i8, brand_codes, n_brands):
+    """
+    One pass over sale rows sorted by (customer, date), returning per repeat
+    customer: the first brand, the most common later brand (ties broken by the
+    lowest code) and the mean days between consecutive sales.
+    """
+    n = customer_ids.shape[0]
+    hist = np.zeros(n_brands, dtype=np.int64)
+    out_customer = np.empty(n, dtype=np.int64)
+    out_first = np.empty(n, dtype=np.int64)
+    out_mode = np.empty(n, dtype=np.int64)
+    out_days = np.empty(n, dtype=np.float64)
+    n_out = 0
+    start = 0
+    for i in range(1, n + 1):
+        if i == n or customer_ids[i] != customer_ids[start]:
+            size = i - start
+            if size > 1:
+                best = -1
+                best_count = 0
+                for j in range(start + 1, i):
+                    code = brand_codes[j]
+                    hist[code] += 1
+                    if hist[code] > best_count or (hist[code] == best_count and code < best):
+                        best_count = hist[code]
+                        best = code
+                for j in range(start + 1, i):  # reset only the touched bins
+                    hist[brand_codes[j]] = 0
+                out_customer[n_out] = customer_ids[start]
+                out_first[n_out] = brand_codes[start]
+                out_mode[n_out] = best
+                # mean of consecutive diffs telescopes to (last - first) / gaps
+                out_days[n_out] = (dates_i8[i - 1] - dates_i8[start]) \
+                    / (size - 1) / (86400 * 10 ** 9)
+                n_out += 1
+            start = i
+    return (out_customer[:n_out], out_first[:n_out],
+            out_mode[:n_out], out_days[:n_out])
+
+
 class ReportGenerator:
     """
     Implement the following 4 functions:
@@ -22,22 +67,45 @@ class ReportGenerator:
         self.dbname = dbname
         if not os.path.exists(dbname):
             self.logger.error(f'param dbname: {dbname} does not exists')
-        else:
-            self.con = sqlite3.connect(self.dbname)
-            self.cur = self.con.cursor()
-            self.logger.info(f'open db {dbname} connection')
+            raise FileNotFoundError(dbname)
+        self.con = sqlite3.connect(self.dbname, check_same_thread=False,
+                                   isolation_level=None)
+        self.cur = self.con.cursor()
+        self.logger.info(f'open db {dbname} connection')
+        # Tune the connection for read-heavy report queries: WAL journal,
+        # relaxed fsync, a 256 MB page cache, mmap'd reads and in-memory
+        # temp space for sorts and group-bys
+        for pragma in ['journal_mode=WAL',
+                       'synchronous=NORMAL',
+                       'cache_size=-262144',
+                       'mmap_size=1073741824',
+                       'temp_store=MEMORY']:
+            self.cur.execute(f'PRAGMA {pragma}')
+        # Index the join keys and the sale date once, so the WHERE sale_dt
+        # filters become index range scans instead of full table scans
+        for table, column in [('Sales', 'sale_dt'),
+                              ('Sales', 'customer_id'),
+                              ('Invoices', 'invoice_id'),
+                              ('Vehicles', 'vehicle_id'),
+                              ('Vehicle_models', 'vehicle_model_id'),
+                              ('Customers', 'customer_id')]:
+            self.cur.execute(f'CREATE INDEX IF NOT EXISTS '
+                             f'ix_{table.lower()}_{column} ON {table}({column})')
 
 
     def __del__(self):
-        self.con.close()
-        self.logger.info(f'close db {self.dbname} connection')
+        if getattr(self, 'con', None) is not None:
+            self.con.close()
+            self.logger.info(f'close db {self.dbname} connection')
 
     def __to_csv(self, df, filename: str, columns: Optional[List[str]] = None) -> int:
         try:
             if columns:
-                df.to_csv(filename, columns=columns)
-            else:
-                df.to_csv(filename)
+                df = df[columns]
+            if df.index.name is not None:
+                df = df.reset_index()
+            # arrow writes the whole batch in C instead of formatting cell by cell
+            pyarrow.csv.write_csv(pa.Table.from_pandas(df, preserve_index=False), filename)
             return 0
         except Exception as ex:
             self.logger.error(f'Can\'t write over file {filename}\n. Error: {str(ex)}')
@@ -60,37 +128,39 @@ class ReportGenerator:
         :param str filename: Output file name
         """
 
-        # Get the whole database to do the logic with python
-        sales = pd.read_sql_query("SELECT * FROM Sales", self.con)
-        vehicles = pd.read_sql_query("SELECT * FROM Vehicles", self.con)
-        invoices = pd.read_sql_query("SELECT * FROM Invoices", self.con)
-        vehicle_models = pd.read_sql_query("SELECT * FROM Vehicle_models", self.con)
+        # Join, group and sort in the database, only the final groups reach python
+        df = pd.read_sql_query("SELECT brand_name, COUNT(*) AS n_sales, SUM(price) AS total_value "
+                               "FROM Sales "
+                               "JOIN Invoices USING(invoice_id) "
+                               "JOIN Vehicles USING(vehicle_id) "
+                               "JOIN Vehicle_models USING(vehicle_model_id) "
+                               "GROUP BY brand_name "
+                               "ORDER BY n_sales DESC, total_value DESC",
+                               self.con, dtype_backend='pyarrow')
 
         self.logger.info(f'Querying db tables: sales, vehicles, invoices, vehicle_models')
 
-        # join df's by Foreign keys
-        df = pd.merge(
-                pd.merge(
-                    pd.merge(sales, invoices, on='invoice_id'),
-                    vehicles, on='vehicle_id', how='left'),
-                vehicle_models, on='vehicle_model_id', how='left'
-        )
-        del sales, vehicles, invoices, vehicle_models
-
-        # Check nulls values
-        if any(df.isnull().sum() > 0):
-            self.logger.debug(f'There is records with nulls values: \n{df.isnull().sum()}')
-            df.dropna(inplace=True)
-
-        # Group rows by brand_name
-        df = df.groupby('brand_name', as_index=False).agg({'sale_id': 'size', 'price': 'sum'})
-
-        df.rename(columns={'brand_name': 'vehicle_brand',
-                           'sale_id': 'n_sales',
-                           'price': 'total_value'},
-                  inplace=True)
-        df.sort_values(['n_sales', 'total_value'], ascending=False, inplace=True)
+        df.rename(columns={'brand_name': 'vehicle_brand'}, inplace=True)
+
+        return self.__to_csv(df, filename)
 
+    def __customers_report(self, op: str, cutoff: str, filename: str) -> int:
+        # Shared body of new_customers / old_customers, which differ only in
+        # how each customer's latest sale compares against a cutoff date. The
+        # whole report runs in the database: the subquery keeps one (customer,
+        # latest sale) pair per qualifying customer and the joins fill in the
+        # name and vehicle columns, already aliased and sorted for the CSV
+        df = pd.read_sql_query("SELECT customer_name, brand_name AS vehicle_brand, "
+                               "model_name AS vehicle_model, vehicle_year, sale_dt "
+                               "FROM Sales "
+                               "JOIN (SELECT customer_id, MAX(sale_dt) AS sale_dt "
+                               "FROM Sales GROUP BY customer_id "
+                               f"HAVING MAX(sale_dt) {op} ?) USING(customer_id, sale_dt) "
+                               "JOIN Customers USING(customer_id) "
+                               "JOIN Vehicles USING(vehicle_id) "
+                               "JOIN Vehicle_models USING(vehicle_model_id) "
+                               "ORDER BY customer_name",
+                               self.con, params=(cutoff,), dtype_backend='pyarrow')
         return self.__to_csv(df, filename)
 
     def new_customers(self, filename: str) -> int:
@@ -110,40 +180,7 @@ class ReportGenerator:
 
         :param str filename: Output file name
         """
-        # Get the whole database to do the logic with python
-        sales = pd.read_sql_query("SELECT * FROM Sales", self.con, parse_dates=['sale_dt'])
-        vehicles = pd.read_sql_query("SELECT * FROM Vehicles", self.con)
-        vehicle_models = pd.read_sql_query("SELECT * FROM Vehicle_models", self.con)
-        customers = pd.read_sql_query("SELECT * FROM Customers", self.con)
-
-        df = pd.merge(
-                pd.merge(pd.merge(sales, customers, on='customer_id'),
-                         vehicles, on='vehicle_id', how='left'),
-                vehicle_models, on='vehicle_model_id', how='left'
-            )
-        del sales, vehicles, vehicle_models, customers
-
-        # Check nulls values
-        if any(df.isnull().sum() > 0):
-            self.logger.debug(f'There is records with nulls values: \n{df.isnull().sum()}')
-            df.dropna(inplace=True)
-
-        # filter rows by sales after 2020-01-01 and group by customers
-        df = df[df.sale_dt >= dt.datetime(2020, 1, 1)]
-        df = df.groupby('customer_id', as_index=False).agg({'sale_dt': 'max',
-                                                            'customer_name': 'first',
-                                                            'brand_name': 'first',
-                                                            'model_name': 'first',
-                                                            'vehicle_year': 'first'})
-
-        df.rename(columns={'brand_name': 'vehicle_brand',
-                           'model_name': 'vehicle_model'},
-                  inplace=True)
-        df.sort_values(['customer_name'], inplace=True)
-
-        return self.__to_csv(df, filename, columns=['customer_name', 'vehicle_brand',
-                                                    'vehicle_model', 'vehicle_year',
-                                                    'sale_dt'])
+        return self.__customers_report('>=', '2020-01-01', filename)
 
     def old_customers(self, filename):
         """
@@ -162,39 +199,7 @@ class ReportGenerator:
 
         :param str filename: Output file name
         """
-        sales = pd.read_sql_query("SELECT * FROM Sales", self.con, parse_dates=['sale_dt'])
-        vehicles = pd.read_sql_query("SELECT * FROM Vehicles", self.con)
-        vehicle_models = pd.read_sql_query("SELECT * FROM Vehicle_models", self.con)
-        customers = pd.read_sql_query("SELECT * FROM Customers", self.con)
-
-        df = pd.merge(
-            pd.merge(pd.merge(sales, customers, on='customer_id'),
-                     vehicles, on='vehicle_id', how='left'),
-            vehicle_models, on='vehicle_model_id', how='left'
-        )
-        del sales, vehicles, vehicle_models, customers
-
-        # Check nulls values
-        if any(df.isnull().sum() > 0):
-            self.logger.debug(f'There is records with nulls values: \n{df.isnull().sum()}')
-            df.dropna(inplace=True)
-
-        # filter rows by sales before 2016-01-01 and group by customers
-        df = df[df.sale_dt <= dt.datetime(2016, 1, 1)]
-        df = df.groupby('customer_id', as_index=False).agg({'sale_dt': 'max',
-                                                            'customer_name': 'first',
-                                                            'brand_name': 'first',
-                                                            'model_name': 'first',
-                                                            'vehicle_year': 'first'})
-
-        df.rename(columns={'brand_name': 'vehicle_brand',
-                           'model_name': 'vehicle_model'},
-                  inplace=True)
-        df.sort_values(['customer_name'], inplace=True)
-
-        return self.__to_csv(df, filename, columns=['customer_name', 'vehicle_brand',
-                                                    'vehicle_model', 'vehicle_year',
-                                                    'sale_dt'])
+        return self.__customers_report('<=', '2016-01-01', filename)
 
 
     def next_vehicle(self, filename):
@@ -213,30 +218,32 @@ class ReportGenerator:
 
         :param str filename: Output file name
         """
-        sales = pd.read_sql_query("SELECT * FROM Sales", self.con, parse_dates=['sale_dt'])
-        vehicles = pd.read_sql_query("SELECT * FROM Vehicles", self.con)
-        vehicle_models = pd.read_sql_query("SELECT * FROM Vehicle_models", self.con)
-        customers = pd.read_sql_query("SELECT * FROM Customers", self.con)
-
-        df = pd.merge(
-            pd.merge(pd.merge(sales, customers, on='customer_id'),
-                     vehicles, on='vehicle_id', how='left'),
-            vehicle_models, on='vehicle_model_id', how='left'
-        )
-        del sales, vehicles, vehicle_models, customers
-
-        customers_id = df.groupby('customer_id')['sale_dt'].size()
-        customers_id = customers_id[customers_id > 1]
-        df = df[df.customer_id.isin(customers_id.index.values)]
-
-        df.sort_values('sale_dt', inplace=True)
-
-        df_ = df.groupby('customer_id').agg({'brand_name': lambda x: pd.Series.mode(x)[0]}) \
-            .rename(columns={'brand_name': 'most_common_second_veh_brand'})
-        df_ = pd.merge(df_,
-                       df.groupby('customer_id').agg({'brand_name': 'first'}) \
-                       .rename(columns={'brand_name': 'first_veh_brand'}),
-                       on='customer_id', how='left')
+        # Join in the database, projecting only the columns the report uses
+        df = pd.read_sql_query("SELECT customer_id, sale_dt, brand_name "
+                               "FROM Sales "
+                               "JOIN Customers USING(customer_id) "
+                               "LEFT JOIN Vehicles USING(vehicle_id) "
+                               "LEFT JOIN Vehicle_models USING(vehicle_model_id)",
+                               self.con, parse_dates=['sale_dt'],
+                               dtype_backend='pyarrow')
+
+        # sort once by (customer, date), then one compiled pass computes the
+        # first brand, the later-brand mode and the mean gap per customer.
+        # np.lexsort permutes only the three key arrays, so the frame itself
+        # (with its string column) never gets rearranged
+        customers = df['customer_id'].to_numpy(dtype='int64')
+        dates = df['sale_dt'].to_numpy(dtype='datetime64[ns]').view('i8')
+        brands = df['brand_name'].astype('category')
+        brand_codes = brands.cat.codes.to_numpy(dtype='int64')
+        order = np.lexsort((dates, customers))
+        customer_ids, first_codes, mode_codes, avg_days = _next_vehicle_kernel(
+            customers[order], dates[order], brand_codes[order],
+            len(brands.cat.categories))
+
+        df_ = pd.DataFrame({'most_common_second_veh_brand': brands.cat.categories[mode_codes],
+                            'first_veh_brand': brands.cat.categories[first_codes],
+                            'avg_days_between_sales': avg_days.round()},
+                           index=pd.Index(customer_ids, name='customer_id'))
 
         df_.sort_values(['first_veh_brand'], inplace=True)
         return self.__to_csv(df_, filename)
\ No newline at end of file
@@ -4,6 +4,8 @@ from setuptools import find_packages, setup
 packages = [
     "pandas",
     "numpy",
+    "pyarrow",
+    "numba",
     "pytest<7,>=5",
     "pytest-timeout",
 ]